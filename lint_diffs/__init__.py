@@ -8,26 +8,44 @@ Exports:
 """
 
 import sys
-import subprocess
-import io
 import re
 import os
-import configparser
+import shutil
 import logging
-import argparse
-import multiprocessing.dummy
+import collections
+import collections.abc
 from threading import Lock
+from functools import lru_cache
 
-from typing import NamedTuple
-from unidiff import PatchSet
+from typing import NamedTuple, TYPE_CHECKING
+
+# configparser, subprocess, argparse and friends are imported where they are used,
+# so importing lint_diffs (tests, hooks) doesn't pay for them up front
+# pylint: disable=import-outside-toplevel
+if TYPE_CHECKING:
+    import configparser
 
 
 log = logging.getLogger("lint_diffs")
 __all__ = ["main"]
 __version__ = "0.1.22"
 USER_CONFIG = "~/.config/lint-diffs"
+DEFAULT_CONFIG = os.path.join(os.path.dirname(__file__), "default_config")
 CONSOLE_LOCK = Lock()
 NOTFOUND = -9
+STREAM_BLOCK = 65536
+CFG_CACHE_SIZE = 16
+MAX_PARALLEL = 16
+SHARD_CHARS = 32000     # fits the windows command line limit, far below ARG_MAX elsewhere
+_CFG_CACHE = {}
+_PARSE_CACHE = {}
+_BACKSLASH_TRANS = str.maketrans("\\", "/")
+# a file's ---/+++ header pair, or one of its hunk headers
+_DIFF_RE = re.compile(r"^--- (?P<source>[^\t\n]+)[^\n]*\n\+\+\+ (?P<target>[^\t\n]+)"
+                      r"|^@@ -\d+(?:,(?P<old_len>\d+))? \+(?P<start>\d+)(?:,(?P<len>\d+))? @@", re.MULTILINE)
+_PATCH_PREFIX_RE = re.compile(r"[abciow12]/")
+# output lines starting with these are blank, indented or separators, never a file name
+_SKIP_PREFIX = r"(?![\s*=-])"
 
 
 class LintResult(NamedTuple):
@@ -48,17 +66,141 @@ class LintResult(NamedTuple):
         return self.always + self.mine     # pylint: disable=no-member
 
 
-def read_config(args) -> configparser.ConfigParser:
-    """Read the default config, then read the user config."""
+class LineSet(collections.abc.Set):
+    """Set of line numbers, stored as a bitmap with one bit per line."""
+
+    __slots__ = ("_bits",)
+
+    def __init__(self, bits: bytes = b""):
+        self._bits = bits.rstrip(b"\0")
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        """Set of the line numbers in each (start, stop) range, filled a byte at a time."""
+        bits = bytearray((max((stop for _, stop in ranges), default=0) + 7) // 8)
+        for start, stop in ranges:
+            if start >= stop:
+                continue
+            first, last = start >> 3, (stop - 1) >> 3
+            head = (0xff << (start & 7)) & 0xff
+            tail = 0xff >> (7 - ((stop - 1) & 7))
+            if first == last:
+                bits[first] |= head & tail
+            else:
+                bits[first] |= head
+                bits[first + 1:last] = b"\xff" * (last - first - 1)
+                bits[last] |= tail
+        return cls(bytes(bits))
+
+    @classmethod
+    def _from_iterable(cls, it):
+        bits = bytearray()
+        for lno in it:
+            idx = lno >> 3
+            if idx >= len(bits):
+                bits.extend(bytes(idx + 1 - len(bits)))
+            bits[idx] |= 1 << (lno & 7)
+        return cls(bytes(bits))
+
+    def __contains__(self, lno):
+        if not isinstance(lno, int) or lno < 0:
+            return False
+        idx = lno >> 3
+        return idx < len(self._bits) and bool(self._bits[idx] >> (lno & 7) & 1)
+
+    def __iter__(self):
+        for idx, byte in enumerate(self._bits):
+            if byte:
+                yield from (idx * 8 + bit for bit in range(8) if byte >> bit & 1)
+
+    def __len__(self):
+        return bin(int.from_bytes(self._bits, "little")).count("1")
+
+    def __bool__(self):
+        return bool(self._bits)
+
+    def __repr__(self):
+        return "LineSet(%s)" % sorted(self)
+
+
+_NO_LINES = LineSet()
+# files the diffs delete, told apart by identity from files that only lost lines
+_DELETED = LineSet()
+
+
+def _config_paths(args):
+    """Config files, in the order they're read: default, user, then local."""
+    return [
+        DEFAULT_CONFIG,
+        os.path.expanduser(args.config),
+        ".lint_diffs",
+    ]
+
+
+def _config_stats(paths):
+    """Identify config files by path, mtime and size, so changes can be noticed."""
+    stats = []
+    for path in paths:
+        try:
+            info = os.stat(path)
+            stats.append((os.path.abspath(path), info.st_mtime_ns, info.st_size))
+        except OSError:
+            stats.append((os.path.abspath(path), None, None))
+    return tuple(stats)
+
+
+def _copy_config(config) -> "configparser.ConfigParser":
+    """Copy a parsed config, without interpolating values."""
+    import configparser
+
+    copied = configparser.ConfigParser()
+    sections = {sec: dict(config.items(sec, raw=True)) for sec in config.sections()}
+    copied.read_dict({config.default_section: config.defaults(), **sections})
+    return copied
+
+
+def _toml_to_str(val) -> str:
+    """Format a TOML value the way it would be written in an ini config."""
+    if isinstance(val, bool):
+        return "true" if val else "false"
+    if isinstance(val, list):
+        return " ".join(str(elem) for elem in val)
+    return str(val)
+
+
+def _read_config_toml(config, path):
+    """Merge a TOML config file into config, each table is a section."""
+    try:
+        import tomllib
+    except ImportError:     # python < 3.11
+        tomllib = None
+
+    try:
+        with open(path, "rb") as toml_file:
+            if tomllib is None:
+                log.error("Ignoring %s, TOML config needs python 3.11 or later", path)
+                return
+            data = tomllib.load(toml_file)
+    except FileNotFoundError:
+        return
+
+    config.read_dict({name: {key: _toml_to_str(val) for key, val in table.items()}
+                      for name, table in data.items() if isinstance(table, dict)})
+
+
+def _parse_config(sources) -> "configparser.ConfigParser":
+    """Parse config sources in order, each a path or a file-like object with ini text."""
+    import configparser
+
     config = configparser.ConfigParser()
 
-    config.read(
-        [
-            os.path.join(os.path.dirname(__file__), 'default_config'),
-            os.path.expanduser(args.config),
-            ".lint_diffs",
-        ]
-    )
+    for src in sources:
+        if hasattr(src, "read"):
+            config.read_file(src)
+        elif src.endswith(".toml"):
+            _read_config_toml(config, src)
+        else:
+            config.read(src)
 
     if "main" not in config:
         config.add_section("main")
@@ -66,18 +208,55 @@ def read_config(args) -> configparser.ConfigParser:
     return config
 
 
+def _read_config_from_stream(stream) -> "configparser.ConfigParser":
+    """Read the default config, then config text from stream, then the local config.
+
+    The stream is read once and never cached, since it can't be checked for changes.
+    """
+    return _parse_config([DEFAULT_CONFIG, stream, ".lint_diffs"])
+
+
+def read_config(args) -> "configparser.ConfigParser":
+    """Read the default config, then read the user config.
+
+    args.config is a path, or a file-like object with the user config.
+    Parsed files are cached until one of them changes, callers get their own copy.
+    """
+    if hasattr(args.config, "read"):
+        return _read_config_from_stream(args.config)
+
+    paths = _config_paths(args)
+    key = _config_stats(paths)
+    config = _PARSE_CACHE.get(key)
+    if config is None:
+        config = _parse_config(paths)
+
+        if len(_PARSE_CACHE) >= CFG_CACHE_SIZE:
+            _PARSE_CACHE.clear()
+        _PARSE_CACHE[key] = config
+
+    return _copy_config(config)
+
+
+_BOOL_STRS = {"true": True, "false": False}
+
+
+@lru_cache(maxsize=128)
 def _str_to_int_or_bool(val: str) -> int:
-    if val.lower() == "true":
-        return True
-    if val.lower() == "false":
-        return False
+    if not val:
+        raise ValueError("expected an integer or true/false, got an empty string")
+    lowered = val.lower()
+    if lowered in _BOOL_STRS:
+        return _BOOL_STRS[lowered]
     return int(val)
 
 
 def _config_to_dict(config) -> dict:
     """Convert dict to internal dictionary."""
     final = {}
+    ext_map = {}
     for secname, sec in config.items():
+        sec = dict(sec)
         final[secname] = sec
 
         ext = sec.get("extensions")
@@ -97,12 +276,32 @@ def _config_to_dict(config) -> dict:
         if not ok:
             continue
 
-        for ext in ext.split(" "):
-            ext.strip()
-            if ext not in final:
-                final[ext] = []
+        # files go in place of a "$@" placeholder, or at the end
+        parts = cmd.split(" ")
+        at = parts.index('"$@"') if '"$@"' in parts else len(parts)
+        sec["_cmd_pre"], sec["_cmd_post"] = parts[:at], parts[at + 1:]
+
+        # linter output is nearly always ascii, where \d, \w and \s are cheaper to match
+        flags = 0 if _str_to_int_or_bool(sec.get("unicode", "false")) else re.ASCII
+
+        # sharding is opt-in, linters with fixed targets or cross-file checks need every file in one run
+        sec["_shard_size"] = _str_to_int_or_bool(sec.get("shard_size", "0"))
+
+        try:
+            sec["_regex_re"] = _compile_output_regex(regex, flags)
+            always_report = sec.get("always_report")
+            sec["_always_re"] = _compiled(always_report, flags) if always_report else None
+        except re.error as ex:
+            log.error("Invalid regex for %s (%s), skipping", secname, ex)
+            continue
 
-            final[ext].append(secname)
+        for ext in ext.split():
+            if ext not in ext_map:
+                ext_map[ext] = []
+
+            ext_map[ext].append(secname)
+
+    final["_ext_to_linters"] = {ext: tuple(linters) for ext, linters in ext_map.items()}
 
     if "main" in final:
         for key, val in final["main"].items():
@@ -113,17 +312,95 @@ def _config_to_dict(config) -> dict:
     return final
 
 
+def _config_key(args):
+    """Identify a loaded config by its files' stats and the command line options, None if uncacheable."""
+    if hasattr(args.config, "read"):
+        return None
+    return _config_stats(_config_paths(args)), args.debug, args.parallel, args.strict, tuple(args.option)
+
+
+def invalidate_config_cache():
+    """Forget cached configs, so the next run rereads every config file."""
+    _PARSE_CACHE.clear()
+    _CFG_CACHE.clear()
+
+
+def _load_config(args) -> dict:
+    """Read config files and command line options into the internal dictionary, cached until a file changes."""
+    key = _config_key(args)
+    config = _CFG_CACHE.get(key)
+    if config is None:
+        py_config = read_config(args)
+        _alter_config_with_args(args, py_config)
+        config = _config_to_dict(py_config)
+        if key is not None:
+            if len(_CFG_CACHE) >= CFG_CACHE_SIZE:
+                _CFG_CACHE.clear()
+            _CFG_CACHE[key] = config
+    return config
+
+
+def _diff_path(source, target):
+    """Path of the file a diff applies to, without quotes or an a/ b/ prefix."""
+    path = source if target == "/dev/null" else target
+    if path.startswith('"') and path.endswith('"'):
+        path = path[1:-1]
+    if _PATCH_PREFIX_RE.match(path):
+        path = path[2:]
+    return path
+
+
+def _hunk_lines(text, pos, old_len, new_len):
+    """Count the lines of the hunk body starting at pos."""
+    count = 0
+    while old_len > 0 or new_len > 0:
+        kind = text[pos:pos + 1]
+        if kind == "-":
+            old_len -= 1
+        elif kind == "+":
+            new_len -= 1
+        elif kind != "\\":
+            # context, git may strip the space from empty ones
+            old_len -= 1
+            new_len -= 1
+        count += 1
+        pos = text.find("\n", pos) + 1
+        if not pos:
+            break
+    return count
+
+
 def read_diffs():
-    """Read the diffs from stdin, must be parsable by unidiff."""
-    patch_set = PatchSet(sys.stdin)
+    """Read unified diffs from stdin, return a LineSet of the changed line numbers of each file.
+
+    Deleted files map to _DELETED, an empty LineSet.
+    """
+    text = sys.stdin.read()
     diff_lines = {}
-    for patch in patch_set:
-        lnos = set()
-        for hunk in patch:
-            for line_info in hunk.target_lines():
-                lnos.add(line_info.target_line_no)
-        diff_lines[patch.path] = lnos
-    return diff_lines
+    deleted = set()
+    lnos = None
+    hunk = (0, 0, 0)
+    for match in _DIFF_RE.finditer(text):
+        if match["target"]:
+            if lnos is not None:
+                # a removed "-- x" then an added "++ y" look like a file header, skip them
+                # when they're within the last hunk's body, walking it only when unsure
+                body, old_len, new_len = hunk
+                idx = text.count("\n", body, match.start())
+                if idx < max(old_len, new_len) or (idx < old_len + new_len and idx < _hunk_lines(text, *hunk)):
+                    continue
+            path = sys.intern(_diff_path(match["source"], match["target"]))
+            lnos = diff_lines.setdefault(path, [])
+            if match["target"] == "/dev/null":
+                deleted.add(path)
+            else:
+                deleted.discard(path)
+        elif lnos is not None:
+            start, length = int(match["start"]), int(match["len"] or 1)
+            # target lines (added and context) are always one contiguous run
+            lnos.append((start, start + length))
+            hunk = (text.find("\n", match.end()) + 1, int(match["old_len"] or 1), length)
+    return {path: _DELETED if path in deleted else LineSet.from_ranges(ranges) for path, ranges in diff_lines.items()}
 
 
 def do_lint(config, linter, diffs, files):
@@ -135,82 +412,234 @@ def do_lint(config, linter, diffs, files):
         diffs: dict of filename to lineno set
         files: list of file paths
     """
+    import subprocess
+
     cmd = config[linter]["command"]
-    always_report = config[linter].get("always_report")
-    regex = config[linter]["regex"]
-
-    log.debug("linter: %s %s %s", cmd, regex, always_report)
-
-    cmd = cmd.split(" ")
-    placeholder_found = False
-    joined = []
-    for elem in cmd:
-        if elem == '"$@"':
-            joined += files
-            placeholder_found = True
-        else:
-            joined.append(elem)
+    regex_re = config[linter]["_regex_re"]
+    always_re = config[linter]["_always_re"]
+
+    log.debug("linter: %s %s %s", cmd, regex_re.pattern, always_re and always_re.pattern)
+
+    joined = config[linter]["_cmd_pre"] + files + config[linter]["_cmd_post"]
 
-    if not placeholder_found:
-        joined += files
+    # with a full path to the executable and close_fds off, Popen can use posix_spawn
+    # instead of fork + exec, and skips closing every fd in the child.  On posix, pipes
+    # python opens are non-inheritable, so other linters' pipes don't leak into this one.
+    # Windows passes every inheritable handle unless close_fds is on, including the pipe
+    # ends Popen is creating for linters started at the same time, so keep it on there.
+    joined[0] = shutil.which(joined[0]) or joined[0]
+    close_fds = os.name != "posix"
 
     try:
-        ret = subprocess.run(joined, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding="utf8", check=False)
+        proc = subprocess.Popen(joined, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding="utf8",
+                                close_fds=close_fds)
     except FileNotFoundError:
         return LintResult(returncode=NOTFOUND, skipped=0, total=0,
                           mine=0, always=0, other=0, output="Command not found for '%s'\n" % linter)
 
-    return parse_output(config, diffs, ret, regex, always_report)
-
-
-def parse_output(config, diffs, ret, regex, always_report):
-    """Parse linter output."""
-    skipped_cnt = 0
-    total_cnt = 0
-    always_cnt = 0
-    mine_cnt = 0
-    other_cnt = 0
-    outf = io.StringIO()
-    prev_m = False
-
-    for line in ret.stdout.split("\n"):
-        total_cnt += 1
-        match = re.match(regex, line)
-        if not match:
-            skipped_cnt += 1
-            if prev_m or config.get("debug"):
-                print("#", line, file=outf)
-            continue
+    # parse while the linter is still running, rather than buffering all of its output
+    parser = _OutputParser(config, diffs, regex_re, always_re)
+    with proc:
+        for block in _read_blocks(proc.stdout):
+            parser.feed(block)
+
+    return parser.result(proc.returncode)
+
 
-        fname, lno, err = match["file"], match["line"], match["err"]
-        fname = fname.translate(str.maketrans("\\", "/"))
+@lru_cache(maxsize=128)
+def _compiled(pat, flags=0):
+    """Compile a regex, reusing the result when the same pattern is seen again."""
+    return re.compile(pat, flags)
 
+
+@lru_cache(maxsize=128)
+def _compile_output_regex(regex, flags=0):
+    """Compile a linter regex to match lines in place within an output block.
+
+    Regexes that start with the file name also reject lines by their first character,
+    before running the rest of the pattern.  MULTILINE lets a ^ in the regex match at
+    the start of any line, not just the first in the block.
+    """
+    prefix = _SKIP_PREFIX if regex.startswith("(?P<file>") else ""
+    return re.compile(prefix + regex, re.MULTILINE | flags)
+
+
+def _read_blocks(stream, size=STREAM_BLOCK):
+    """Read a text stream as it arrives, yielding blocks of whole lines, without their final newline."""
+    rest = ""
+    for block in iter(lambda: stream.read(size), ""):
+        block = rest + block
+        eol = block.rfind("\n")
+        if eol == -1:
+            rest = block
+            continue
+        yield block[:eol]
+        rest = block[eol + 1:]
+    if rest:
+        yield rest
+
+
+class _OutputParser:
+    """Incremental linter output parser, fed one block of whole lines at a time."""
+
+    def __init__(self, config, diffs, regex_re, always_re):
+        self.debug = config.get("debug")
+        self.diffs = diffs
+        self.regex_re = regex_re
+        self.always_re = always_re
+        self.counts = dict.fromkeys(("skipped", "total", "always", "mine", "other"), 0)
+        self.out_lines = []
+        self.prev_m = False
+
+    def feed(self, text):
+        """Parse a block of lines.
+
+        Each line is matched in place, bounded by its end, rather than split out of the block.
+        """
+        regex_re = self.regex_re
+        end = len(text)
+        pos = skip_from = 0
+        while pos <= end:
+            eol = text.find("\n", pos)
+            if eol == -1:
+                eol = end
+            # endpos keeps patterns like [^:]+ from running on into the following lines
+            match = regex_re.match(text, pos, eol)
+            if match:
+                # lines between the previous match and this one were skipped
+                if pos > skip_from:
+                    self._skip(text[skip_from:pos - 1])
+                self._match(match, text[pos:eol])
+                skip_from = eol + 1
+            pos = eol + 1
+
+        if end >= skip_from:
+            self._skip(text[skip_from:end])
+
+        self.counts["total"] += text.count("\n") + 1
+
+    def _skip(self, gap):
+        """Count lines that didn't match, output them if they follow a reported line."""
+        self.counts["skipped"] += gap.count("\n") + 1
+        if self.prev_m or self.debug:
+            self.out_lines.extend("# " + line for line in gap.split("\n"))
+
+    def _match(self, match, line):
+        """Count a matching line, output it if it's in the diffs or always reported."""
+        fname = match["file"]
+        if "\\" in fname:
+            fname = fname.translate(_BACKSLASH_TRANS)
+
+        self.prev_m = False
+        lines = self.diffs.get(fname, _NO_LINES)
+        if not lines and not self.always_re:
+            # not a diffed file, and nothing is always reported: skip the rest
+            self.counts["other"] += 1
+            return
+
+        # the default regexes only match digits, but custom ones might not
+        lno = match["line"]
         try:
             lno = int(lno)
         except ValueError:
             log.debug("lineno parse issue: %s", line)
 
-        prev_m = False
-        always_match = False
+        if lno in lines:
+            self.counts["mine"] += 1
+        elif self.always_re and self.always_re.match(match["err"]):
+            # only errors outside the diffs need checking against always_report
+            self.counts["always"] += 1
+        else:
+            self.counts["other"] += 1
+            return
 
-        if always_report:
-            match = re.match(always_report, err)
-            if match:
-                always_match = True
+        self.prev_m = True
+        self.out_lines.append(line)
 
-        if lno not in diffs.get(fname, []):
-            if not always_match:
-                other_cnt += 1
-                continue
-            always_cnt += 1
+    def result(self, returncode) -> LintResult:
+        """Summarize everything parsed so far."""
+        output = "\n".join(self.out_lines) + "\n" if self.out_lines else ""
+        return LintResult(returncode=returncode, output=output, **self.counts)
+
+
+def parse_output(config, diffs, ret, regex_re, always_re):
+    """Parse linter output, using the regex and always_report patterns.
+
+    Patterns should be compiled once, regex_re with _compile_output_regex, but plain
+    strings are compiled here.
+    """
+    if isinstance(regex_re, str):
+        regex_re = _compile_output_regex(regex_re)
+    if isinstance(always_re, str):
+        always_re = _compiled(always_re)
+
+    parser = _OutputParser(config, diffs, regex_re, always_re)
+    stdout = ret.stdout
+    if stdout.endswith("\n"):
+        # same lines as splitlines(), the final newline doesn't start an empty line
+        stdout = stdout[:-1]
+    elif not stdout:
+        return parser.result(ret.returncode)
+    parser.feed(stdout)
+    return parser.result(ret.returncode)
+
+
+def _shard_files(files, max_files, max_chars=SHARD_CHARS):
+    """Split files into lists short enough for one linter command line."""
+    shard = []
+    size = 0
+    for fname in files:
+        if shard and (len(shard) >= max_files > 0 or size + len(fname) >= max_chars):
+            yield shard
+            shard = []
+            size = 0
+        shard.append(fname)
+        size += len(fname) + 1
+    if shard:
+        yield shard
+
+
+def _linter_jobs(config, linters):
+    """One (linter, files) job per linter, or one per shard for linters with a shard_size."""
+    jobs = []
+    for linter, files in linters.items():
+        files = sorted(files)
+        shard_size = config[linter]["_shard_size"]
+        if shard_size > 0:
+            jobs.extend((linter, shard) for shard in _shard_files(files, shard_size))
         else:
-            mine_cnt += 1
+            jobs.append((linter, files))
+    return jobs
+
+
+def _merge_results(first, second) -> LintResult:
+    """Combine results from running one linter on separate shards of files."""
+    if first.returncode == NOTFOUND:
+        return first
+    return LintResult(skipped=first.skipped + second.skipped, total=first.total + second.total,
+                      mine=first.mine + second.mine, always=first.always + second.always,
+                      other=first.other + second.other, returncode=first.returncode or second.returncode,
+                      output=first.output + second.output)
 
-        prev_m = True
-        print(line, file=outf)
 
-    return LintResult(returncode=ret.returncode, skipped=skipped_cnt, total=total_cnt,
-                      mine=mine_cnt, always=always_cnt, other=other_cnt, output=outf.getvalue())
+def _default_parallelism():
+    """Number of cpus this process may run on, which respects affinity masks and cpusets."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:      # not on linux
+        cpus = os.cpu_count() or 1
+    return min(cpus, MAX_PARALLEL)
+
+
+def _run_jobs(func, jobs, parallel):
+    """Call func(*job) for each job on a thread pool, yielding results as they finish."""
+    import concurrent.futures
+
+    # linters are subprocesses, so a thread only waits on a pipe while its linter runs
+    with concurrent.futures.ThreadPoolExecutor(parallel) as pool:
+        futures = [pool.submit(func, *job) for job in jobs]
+        for fut in concurrent.futures.as_completed(futures):
+            yield fut.result()
 
 
 def _alter_config_with_args(args, config):
@@ -238,16 +667,27 @@ def _alter_config_with_args(args, config):
         config[name][opt] = val
 
 
-def _parse_args():
+@lru_cache(maxsize=None)
+def _build_parser():
+    import argparse
+
     parser = argparse.ArgumentParser(
         description='Use unified diff from stdin to guide linting.',
         epilog="See https://github.com/AtakamaLLC/lint-diffs for configuration examples.")
     parser.add_argument("--debug", action="store_true", help="Debug regex parsing and lint-diff config", default=None)
-    parser.add_argument("--parallel", action="store", type=int, help="Number of parallel jobs.", default="1")
+    parser.add_argument("--parallel", action="store", type=int, default=None,
+                        help="Number of parallel jobs, 0 or less for the default (one per available cpu, up to %s)" % MAX_PARALLEL)
     parser.add_argument("--strict", action="store_true", help="Fail if linter not installed.", default=None)
-    parser.add_argument("--config", "-c", action="store", help="Location of config (~/.config/lint-diffs)", default=USER_CONFIG)
+    parser.add_argument("--config", "-c", action="store", help="Location of config (~/.config/lint-diffs)", default=None)
     parser.add_argument("--option", "-o", action="append", help="Pass option to underlying linter (name:opt=value)", default=[])
-    args = parser.parse_args()
+    return parser
+
+
+def _parse_args():
+    args = _build_parser().parse_args()
+    # not the parser default, the parser is built once but USER_CONFIG can change
+    if args.config is None:
+        args.config = USER_CONFIG
     return args
 
 
@@ -263,17 +703,17 @@ def main():
     # if this is a problem, remove it
     logging.basicConfig()
 
-    # Read command line arguments and turn on DEBUG logging if asked for so
-    # we can check for debugging information while parsing configuration files
-    args = _parse_args()
-    if args.debug:
-        log.setLevel(logging.DEBUG)
+    _run(_parse_args())
 
-    py_config = read_config(args)
 
-    _alter_config_with_args(args, py_config)
+def _run(args):
+    """Lint the diffs on stdin, as configured by the parsed command line args."""
+    # Turn on DEBUG logging if asked for so we can check for debugging
+    # information while parsing configuration files
+    if args.debug:
+        log.setLevel(logging.DEBUG)
 
-    config = _config_to_dict(py_config)
+    config = _load_config(args)
 
     if config["debug"]:
         log.setLevel(logging.DEBUG)
@@ -282,42 +722,62 @@ def main():
 
     log.debug("diffs: %s", list(diffs))
 
+    ext_to_linters = config["_ext_to_linters"]
     linters = {}
-    for fname in diffs:
+    for fname, lines in diffs.items():
+        if lines is _DELETED:
+            continue
         _, ext = os.path.splitext(fname)
-        if ext in config:
-            for linter_name in config[ext]:
-                if linter_name not in linters:
-                    linters[linter_name] = set()
-                linters[linter_name].add(fname)
+        for linter_name in ext_to_linters.get(ext, ()):
+            if not lines and not config[linter_name]["_always_re"]:
+                # only lost lines, and this linter only reports errors on diff lines
+                continue
+            if linter_name not in linters:
+                linters[linter_name] = set()
+            linters[linter_name].add(fname)
 
     if not linters:
         log.debug("no files need linting")
         return
 
     strict = config.get("strict", False)
-    parallel = config.get("parallel", 1)
+    parallel = config.get("parallel", 0)
+    if parallel <= 0:
+        # unset, or zero/negative on the command line: use the cpus we have
+        parallel = _default_parallelism()
 
     log.debug("linters: %s, strict: %s, parallel: %s", linters, strict, parallel)
 
-    def print_lint(item):
-        """Run linter, print output to screen."""
-        linter, files = item
-        ret = do_lint(config, linter, diffs, list(files))
+    def run_lint(linter, files):
+        """Run linter on one shard of its files."""
+        return linter, do_lint(config, linter, diffs, files)
+
+    def print_lint(linter, ret):
+        """Print output to screen, return the exit code for the linter."""
+        report = "%s\n=== %s: mine=%s, always=%s\n\n" % (ret.output, linter, ret.mine, ret.always)
         with CONSOLE_LOCK:
-            print(ret.output)
-            print("=== %s: mine=%s, always=%s\n" % (linter, ret.mine, ret.always))
+            sys.stdout.write(report)
         if ret.returncode == NOTFOUND:
             return 1 if strict else 0
         return ret.linted > 0 and (ret.returncode or 1)
 
-    if parallel > 1:
-        pool = multiprocessing.dummy.Pool(parallel)
-        mapper = pool.map
-    else:
-        mapper = map
-
-    exitcode = max(mapper(print_lint, linters.items()))
+    def print_all(results):
+        """Merge shard results, printing each linter once all its shards are done."""
+        exitcode = 0
+        merged = {}
+        for linter, ret in results:
+            if linter in merged:
+                ret = _merge_results(merged[linter], ret)
+            merged[linter] = ret
+            shards_left[linter] -= 1
+            if not shards_left[linter]:
+                exitcode = max(exitcode, print_lint(linter, merged.pop(linter)))
+        return exitcode
+
+    jobs = _linter_jobs(config, linters)
+    shards_left = collections.Counter(linter for linter, _ in jobs)
+
+    exitcode = print_all(_run_jobs(run_lint, jobs, parallel))
 
     if exitcode != 0:
         sys.exit(exitcode)
@@ -3,16 +3,20 @@
 # pylint: disable=missing-docstring
 # flake8: noqa=D103
 
+import os
 import sys
 import io
+import re
 import logging
+import subprocess
 
 from tempfile import NamedTemporaryFile
 from unittest.mock import patch,  Mock
 
 import pytest
 
-from lint_diffs import main, read_diffs, read_config, _config_to_dict, _str_to_int_or_bool, parse_output
+from lint_diffs import main, read_diffs, read_config, invalidate_config_cache, _config_to_dict, _load_config, _str_to_int_or_bool, parse_output
+from lint_diffs import LineSet, _compile_output_regex, _default_parallelism, _read_blocks, _shard_files, _OutputParser
 
 
 log = logging.getLogger("lint_diffs")
@@ -101,13 +105,101 @@ def test_parse_out():
         returncode = 0
 
     config = {}
-    regex = r"(?P<file>[^:]+):(?P<line>[^:]+):[^:]+: (?P<err>[^ :]+)"
-    ret = parse_output(config, {"test/badcode.py": [2]}, Ret(), regex, "W0613")
+    raw_regex = r"(?P<file>[^:]+):(?P<line>[^:]+):[^:]+: (?P<err>[^ :]+)"
+    regex = _compile_output_regex(raw_regex)
+    ret = parse_output(config, {"test/badcode.py": [2]}, Ret(), regex, re.compile("W0613"))
     assert ret.skipped == 4
     assert ret.linted == 2
     assert "W0613" in ret.output
     assert "E0602" in ret.output
 
+    # uncompiled patterns are accepted too
+    assert parse_output(config, {"test/badcode.py": [2]}, Ret(), raw_regex, "W0613") == ret
+
+    # a trailing newline doesn't add an empty line
+    Ret.stdout = PYLINT_OUTPUT + "\n"
+    assert parse_output(config, {"test/badcode.py": [2]}, Ret(), regex, re.compile("W0613")) == ret
+
+
+def test_parse_skip_prefix():
+    class Ret:  # pylint: disable=all
+        stdout = "\n  test/badcode.py:2:0: E0602\n*** test/badcode.py:2:0: E0602\ntest/badcode.py:2:0: E0602"
+        returncode = 0
+
+    regex = _compile_output_regex(r"(?P<file>[^:]+):(?P<line>\d+):[^:]+: (?P<err>[^ :]+)")
+    ret = parse_output({}, {"test/badcode.py": [2]}, Ret(), regex, None)
+    assert ret.skipped == 3
+    assert ret.mine == 1
+
+
+def test_parse_no_diff_lines():
+    class Ret:  # pylint: disable=all
+        stdout = PYLINT_OUTPUT
+        returncode = 1
+
+    regex = _compile_output_regex(r"(?P<file>[^:]+):(?P<line>\d+):[^:]+: (?P<err>[^ :]+)")
+    for diffs in ({}, {"test/badcode.py": LineSet()}):
+        ret = parse_output({}, diffs, Ret(), regex, None)
+        assert ret.total == PYLINT_OUTPUT.count("\n") + 1
+        assert ret.linted == 0
+        assert ret.output == ""
+        assert ret.returncode == 1
+
+    # an always_report pattern still needs the output searched
+    ret = parse_output({}, {}, Ret(), regex, re.compile("E0602"))
+    assert ret.always == 1
+    assert "E0602" in ret.output
+
+
+def test_parse_stream_blocks():
+    regex = _compile_output_regex(r"(?P<file>[^:]+):(?P<line>[^:]+):[^:]+: (?P<err>[^ :]+)")
+
+    class Ret:  # pylint: disable=all
+        stdout = PYLINT_OUTPUT
+        returncode = 0
+
+    whole = parse_output({}, {"test/badcode.py": [2]}, Ret(), regex, re.compile("W0613"))
+
+    # tiny reads split lines across blocks, results must not change
+    parser = _OutputParser({}, {"test/badcode.py": [2]}, regex, re.compile("W0613"))
+    for block in _read_blocks(io.StringIO(PYLINT_OUTPUT), size=7):
+        parser.feed(block)
+
+    assert parser.result(0) == whole
+
+
+def test_parse_colon_free_output():
+    regex = _compile_output_regex(r"(?P<file>[^:]+):(?P<line>\d+):[^:]+: (?P<err>[^ :]+)")
+    output = "\n".join("no colons on line %s" % i for i in range(20000)) + "\ntest/badcode.py:2:0: E0602"
+
+    # matches stay within their line, the regex never sees past the end of one
+    seen = []
+
+    class Bounded:  # pylint: disable=all
+        def match(self, text, pos, endpos):
+            seen.append("\n" in text[pos:endpos])
+            return regex.match(text, pos, endpos)
+
+    parser = _OutputParser({}, {"test/badcode.py": [2]}, Bounded(), None)
+    for block in _read_blocks(io.StringIO(output)):
+        parser.feed(block)
+    ret = parser.result(0)
+    assert len(seen) == 20001 and not any(seen)
+    assert ret.skipped == 20000
+    assert ret.mine == 1
+
+
+def test_parse_regex_flags():
+    class Ret:  # pylint: disable=all
+        stdout = "TEST/BADCODE.PY:2:0: E0602\nother\ntest/badcode.py:2:0: W0613"
+        returncode = 0
+
+    # leading inline flags still compile, and ^ matches at the start of every line
+    for raw in (r"(?i)(?P<file>test/badcode\.py):(?P<line>\d+):[^:]+: (?P<err>[^ :]+)",
+                r"^\s*(?P<file>[^:]+):(?P<line>\d+):[^:]+: (?P<err>[^ :]+)"):
+        ret = parse_output({}, {"test/badcode.py": [2]}, Ret(), _compile_output_regex(raw), None)
+        assert (ret.skipped, ret.mine, ret.other) == (1, 1, 1), raw
+
 
 def test_diff_read():
     with patch.object(sys, "stdin", io.StringIO(DIFF_OUTPUT)):
@@ -116,6 +208,72 @@ def test_diff_read():
         assert dlines["test/badcode.py"] == {2}
 
 
+def test_line_set():
+    lines = LineSet.from_ranges([(2, 4), (9, 10), (3, 5)])
+    assert lines == {2, 3, 4, 9}
+    assert 9 in lines and 5 not in lines and 1000 not in lines
+    assert -1 not in lines and "XX" not in lines
+    assert len(lines) == 4
+    assert (lines & {3, 9, 11}) == {3, 9}
+    assert not LineSet() and lines
+
+    for start in range(20):
+        for stop in range(start, 30):
+            assert LineSet.from_ranges([(start, stop), (25, 27)]) == set(range(start, stop)) | {25, 26}
+
+
+def test_diff_read_hunks():
+    diff = """
+diff --git a/test/badcode.py b/test/badcode.py
+index 81e7297..dcdbd1f 100644
+--- a/test/badcode.py
++++ b/test/badcode.py
+@@ -1,3 +1,4 @@ def foo(baz):
+ def foo(baz):
+-    print(bar);
++    print(bar)
++    print(baz)
+ 
+@@ -20,2 +21,0 @@ def foo(baz):
+-    gone
+-    gone
+@@ -30 +29 @@ def foo(baz):
+-    print(bar);
++    print(bar)
+    """
+    with patch.object(sys, "stdin", io.StringIO(diff)):
+        dlines = read_diffs()
+        assert dlines["test/badcode.py"] == {1, 2, 3, 4, 29}
+
+
+def test_diff_read_headers():
+    diff = """
+diff -r 81e7297 -r dcdbd1f test/badcode.py
+--- a/test/badcode.py\tThu Jan 01 00:00:00 1970 +0000
++++ b/test/badcode.py\tThu Jan 01 00:00:00 1970 +0000
+@@ -1,2 +1,2 @@
+--- looks like a header
++++ but is a removed and an added line
+ context
+diff --git a/test/new.py b/test/new.py
+new file mode 100644
+--- /dev/null
++++ b/test/new.py
+@@ -0,0 +1,2 @@
++a = 1
++b = 2
+diff --git a/test/gone.py b/test/gone.py
+deleted file mode 100644
+--- a/test/gone.py
++++ /dev/null
+@@ -1 +0,0 @@
+-a = 1
+    """
+    with patch.object(sys, "stdin", io.StringIO(diff)):
+        dlines = read_diffs()
+        assert dlines == {"test/badcode.py": {1, 2}, "test/new.py": {1, 2}, "test/gone.py": set()}
+
+
 def test_conf_read():
     with NamedTemporaryFile() as conf:
         conf.write(b"""
@@ -135,9 +293,73 @@ always_report=W0613
         assert conf["main"]["debug"]
 
 
-def test_conf_invalid(caplog):
+def test_conf_read_stream():
+    args = Mock(config=io.StringIO("""
+[main]
+debug=True
+
+[pylint]
+always_report=W0613
+"""))
+    conf = read_config(args)
+    assert conf["pylint"]["always_report"] == 'W0613'
+    assert conf["pylint"]["command"]
+    assert conf["main"]["debug"]
+
+    # streams aren't cached, each load parses the stream it's given
+    args = Mock(config=io.StringIO("[flake8]\nextensions=.py\n"), debug=None, parallel=1, strict=None, option=[])
+    cfg = _load_config(args)
+    assert "flake8" in cfg["_ext_to_linters"][".py"]
+    args.config = io.StringIO("")
+    assert _load_config(args) is not cfg
+
+
+def test_conf_read_copies():
     with NamedTemporaryFile() as conf:
         conf.write(b"""
+[pylint]
+always_report=W0613
+        """)
+        conf.flush()
+
+        args = Mock(config=conf.name)
+        first = read_config(args)
+        first["pylint"]["always_report"] = "changed"
+        first.add_section("added")
+
+        second = read_config(args)
+        assert second["pylint"]["always_report"] == 'W0613'
+        assert "added" not in second
+        assert second["pylint"]["regex"] == first["pylint"]["regex"]
+
+
+def test_conf_read_toml():
+    pytest.importorskip("tomllib")
+    with NamedTemporaryFile(suffix=".toml") as conf:
+        conf.write(b"""
+[main]
+debug = true
+parallel = 3
+
+[flake8]
+extensions = [".py", ".pyi"]
+
+[pylint]
+always_report = 'W0613'
+""")
+        conf.flush()
+
+        cfg = _config_to_dict(read_config(Mock(config=conf.name)))
+        assert cfg["debug"] is True
+        assert cfg["parallel"] == 3
+        assert cfg["_ext_to_linters"][".pyi"] == ("flake8",)
+        assert cfg["pylint"]["always_report"] == 'W0613'
+        assert cfg["pylint"]["command"] == 'pylint'
+
+
+def test_conf_invalid(caplog):
+    caplog.clear()
+    args = Mock(config=io.StringIO("""
 [invalid_config]
 extensions=.wack \t \t
 always_report=yeah
@@ -146,38 +368,95 @@ always_report=yeah
 extensions=\t \t.weird \t \t
 command=yo
 regex=(?P<file>[^:]+):(?P<line>\\d+):[^:]+: (?P<err>[^ :]+)
+"""))
+    cfg = read_config(args)
+    exts = _config_to_dict(cfg)
+
+    errs = 0
+    for ent in caplog.records:
+        if ent.levelname == "ERROR":
+            errs += 1
+
+    # invalid extensions don't get loaded
+    assert '.wack' not in exts["_ext_to_linters"]
+
+    # ext with weird whitespace still works
+    assert exts["_ext_to_linters"]['.weird'] == ("ok_config",)
+
+    # missing command + missing regex == 2
+    assert errs == 2
+
+
+def test_conf_bad_regex(caplog):
+    args = Mock(config=io.StringIO("""
+[bad_regex]
+extensions=.bad
+command=yo
+regex=(?P<file>[^:]+):(?P<line>\\d+
+"""))
+    exts = _config_to_dict(read_config(args))
+
+    assert '.bad' not in exts["_ext_to_linters"]
+    assert "Invalid regex for bad_regex" in caplog.text
+
+
+def test_conf_command():
+    cfg = _config_to_dict(read_config(Mock(config=io.StringIO("""
+[wrapped]
+extensions=.wr
+command=sh -c "lint $@" "$@" --strict
+regex=(?P<file>[^:]+):(?P<line>\\d+):[^:]+: (?P<err>[^ :]+)
+"""))))
+    assert cfg["wrapped"]["_cmd_pre"] == ["sh", "-c", '"lint', '$@"']
+    assert cfg["wrapped"]["_cmd_post"] == ["--strict"]
+    assert cfg["pylint"]["_cmd_pre"] == ["pylint"]
+    assert cfg["pylint"]["_cmd_post"] == []
+
+
+def test_conf_unicode():
+    cfg = _config_to_dict(read_config(Mock(config=io.StringIO("""
+[flake8]
+extensions=.py
+unicode=true
+"""))))
+    assert cfg["pylint"]["_regex_re"].flags & re.ASCII
+    assert not cfg["flake8"]["_regex_re"].flags & re.ASCII
+
+
+def test_conf_cache():
+    with NamedTemporaryFile() as conf:
+        conf.write(b"""
+[pylint]
+always_report=W0613
 """)
         conf.flush()
 
-        caplog.clear()
-        args = Mock(config=conf.name)
-        cfg = read_config(args)
-        exts = _config_to_dict(cfg)
-
-        errs = 0
-        for ent in caplog.records:
-            if ent.levelname == "ERROR":
-                errs += 1
+        args = Mock(config=conf.name, debug=None, parallel=1, strict=None, option=[])
+        first = _load_config(args)
+        assert _load_config(args) is first
 
-        # invalid extensions don't get loaded
-        assert '.wack' not in exts
+        invalidate_config_cache()
+        reloaded = _load_config(args)
+        assert reloaded is not first
+        assert reloaded["pylint"]["always_report"] == "W0613"
+        first = reloaded
 
-        # ext with weird whitespace still works
-        assert '.weird' in exts
+        conf.write(b"""
+[flake8]
+extensions=.py
+""")
+        conf.flush()
 
-        # missing command + missing regex == 2
-        assert errs == 2
+        changed = _load_config(args)
+        assert changed is not first
+        assert "flake8" in changed["_ext_to_linters"][".py"]
 
 
 def test_noconf(capsys):
     logging.getLogger().setLevel(logging.INFO)
-    with patch.object(sys, "stdin", io.StringIO(DIFF_OUTPUT)), \
-            NamedTemporaryFile() as conf:
-        conf.write(b"""
-        """)
-        conf.flush()
+    with patch.object(sys, "stdin", io.StringIO(DIFF_OUTPUT)):
         sys.argv = ["whatever"]
-        with patch("lint_diffs.USER_CONFIG", conf.name):
+        with patch("lint_diffs.USER_CONFIG", io.StringIO("")):
             try:
                 main()
             except SystemExit as ex:
@@ -191,18 +470,16 @@ def test_noconf(capsys):
 
 def test_always_report(capsys):
     logging.getLogger().setLevel(logging.INFO)
-    with patch.object(sys, "stdin", io.StringIO(DIFF_OUTPUT)), \
-            NamedTemporaryFile() as conf:
-        conf.write(b"""
+    conf = io.StringIO("""
 [main]
 debug=True
 
 [pylint]
 always_report=W0613
-        """)
-        conf.flush()
+""")
+    with patch.object(sys, "stdin", io.StringIO(DIFF_OUTPUT)):
         sys.argv = ["whatever"]
-        with patch("lint_diffs.USER_CONFIG", conf.name):
+        with patch("lint_diffs.USER_CONFIG", conf):
             try:
                 main()
             except SystemExit as ex:
@@ -225,15 +502,20 @@ test/badcode.py:1:10: E0602: Undefined variable 'bar' (undefined-variable)
 ----------------------------------------------------------------------
 Your code has been rated at -40.00/10 (previous run: -40.00/10, +0.00)"""
 
-    class Ret:  # pylint: disable=all
-        stdout = pylint_output
+    class Proc:  # pylint: disable=all
         returncode = 1
 
         def __init__(self, *a, **k):
+            self.stdout = io.StringIO(pylint_output)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
             pass
 
     with patch.object(sys, "stdin", io.StringIO(DIFF_OUTPUT)):
-        with patch("subprocess.run", Ret):
+        with patch("subprocess.Popen", Proc):
             sys.argv = ["whatever"]
             main()
 
@@ -250,6 +532,88 @@ def test_nolint_txt(caplog):
         assert "no files need linting" in caplog.text
 
 
+def test_no_target_lines(caplog):
+    deleted_only = """
+diff --git a/test/badcode.py b/test/badcode.py
+index 81e7297..dcdbd1f 100644
+--- a/test/badcode.py
++++ b/test/badcode.py
+@@ -2 +1,0 @@ def foo(baz):
+-    print(bar);
+    """
+    with patch.object(sys, "stdin", io.StringIO(deleted_only)), patch("subprocess.Popen") as popen:
+        sys.argv = ["whatever", "--debug"]
+        main()
+
+        popen.assert_not_called()
+        assert "no files need linting" in caplog.text
+
+
+def test_no_target_lines_always_report(capsys):
+    deleted_only = """
+diff --git a/test/badcode.py b/test/badcode.py
+index 81e7297..dcdbd1f 100644
+--- a/test/badcode.py
++++ b/test/badcode.py
+@@ -2 +1,0 @@ def foo(baz):
+-    print(bar);
+diff --git a/test/gone.py b/test/gone.py
+deleted file mode 100644
+--- a/test/gone.py
++++ /dev/null
+@@ -1 +0,0 @@
+-a = 1
+    """
+    calls = []
+
+    class Proc:  # pylint: disable=all
+        returncode = 1
+
+        def __init__(self, cmd, **k):
+            calls.append(cmd[1:])
+            self.stdout = io.StringIO("test/badcode.py:1:0: E0602: Undefined variable\n")
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            pass
+
+    # a linter with always_report still runs on files that only lost lines, but not deleted ones
+    sys.argv = ["whatever", "-o", "pylint:always_report=E"]
+    with patch.object(sys, "stdin", io.StringIO(deleted_only)), patch("subprocess.Popen", Proc), patch("sys.exit") as exited:
+        main()
+        exited.assert_called_once_with(1)
+
+    assert calls == [["test/badcode.py"]]
+    assert "=== pylint: mine=0, always=1" in capsys.readouterr().out
+
+
+def test_popen_args():
+    kwargs = []
+
+    class Proc:  # pylint: disable=all
+        returncode = 0
+
+        def __init__(self, cmd, **k):
+            kwargs.append(k)
+            self.stdout = io.StringIO("")
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            pass
+
+    with patch.object(sys, "stdin", io.StringIO(DIFF_OUTPUT)), patch("subprocess.Popen", Proc):
+        sys.argv = ["whatever"]
+        main()
+
+    # fds are only left open where python's own pipes are non-inheritable
+    assert kwargs == [dict(stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding="utf8",
+                           close_fds=os.name != "posix")]
+
+
 def test_debug_mode(caplog):
     sys.argv = ["whatever", "--debug"]
     with patch.object(sys, "stdin", io.StringIO(GOOD_DIFF_OUTPUT)):
@@ -266,13 +630,16 @@ def test_custom_opts(caplog):
 def test_clang():
     sys.argv = ["whatever", "-o", "clang-tidy:extensions=.cpp .hpp"]
 
-    class Ret:  # pylint: disable=all
-        stdout = CLANG_OUTPUT
+    class Proc:  # pylint: disable=all
         returncode = 1
         def __init__(self, *a, **k):
+            self.stdout = io.StringIO(CLANG_OUTPUT)
+        def __enter__(self):
+            return self
+        def __exit__(self, *exc):
             pass
 
-    with patch.object(sys, "stdin", io.StringIO(DIFF_CPP)), patch("subprocess.run", Ret), patch("sys.exit") as exited:
+    with patch.object(sys, "stdin", io.StringIO(DIFF_CPP)), patch("subprocess.Popen", Proc), patch("sys.exit") as exited:
         main()
         exited.assert_called_once_with(1)
 
@@ -286,6 +653,58 @@ def test_parallel(capsys):
     assert 'E0602' in cap.out       # pylint
     assert 'F821' in cap.out        # flake8
 
+def test_shard_files():
+    files = ["a.py", "b.py", "c.py"]
+    assert list(_shard_files(files, 2)) == [["a.py", "b.py"], ["c.py"]]
+    assert list(_shard_files(files, 0, max_chars=10)) == [["a.py", "b.py"], ["c.py"]]
+    assert list(_shard_files(files, 0)) == [files]
+
+
+def test_sharded(capsys):
+    two_files = DIFF_OUTPUT + DIFF_OUTPUT.replace("test/badcode.py", "test/subd/badcode.py")
+    calls = []
+
+    class Proc:  # pylint: disable=all
+        returncode = 1
+        def __init__(self, cmd, **k):
+            calls.append(cmd[1:])
+            self.stdout = io.StringIO("".join("%s:2:0: E0602: Undefined variable\n" % f for f in cmd[1:]))
+        def __enter__(self):
+            return self
+        def __exit__(self, *exc):
+            pass
+
+    # not sharded unless the linter's section asks for it
+    sys.argv = ["whatever", "--parallel", "2"]
+    with patch.object(sys, "stdin", io.StringIO(two_files)), patch("subprocess.Popen", Proc), patch("sys.exit") as exited:
+        main()
+        exited.assert_called_once_with(1)
+
+    assert calls == [["test/badcode.py", "test/subd/badcode.py"]]
+    assert capsys.readouterr().out.count("=== pylint: mine=2, always=0") == 1
+
+    calls.clear()
+    sys.argv = ["whatever", "--parallel", "2", "-o", "pylint:shard_size=1"]
+    with patch.object(sys, "stdin", io.StringIO(two_files)), patch("subprocess.Popen", Proc), patch("sys.exit") as exited:
+        main()
+        exited.assert_called_once_with(1)
+
+    assert sorted(calls) == [["test/badcode.py"], ["test/subd/badcode.py"]]
+    cap = capsys.readouterr()
+    assert cap.out.count("=== pylint: mine=2, always=0") == 1
+
+
+def test_default_parallelism():
+    assert 1 <= _default_parallelism() <= 16
+
+    # zero or negative --parallel falls back to the default instead of failing
+    for parallel in ("0", "-1"):
+        sys.argv = ["whatever", "--parallel", parallel]
+        with patch.object(sys, "stdin", io.StringIO(GOOD_DIFF_OUTPUT)), patch("sys.exit") as exited:
+            main()
+            exited.assert_not_called()
+
+
 def test_strict():
     sys.argv = ["whatever", "--strict", "-o", "pylint:command=no-such-command"]
 